@@ -8,3 +8,16 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
 
 # OpenAI API Key (для Whisper транскрибации)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+
+# Локальный faster-whisper для длинных голосовых (опционально).
+# Голосовые длиннее порога транскрибируются локально батч-инференсом,
+# если установлен пакет faster-whisper; короткие идут в Whisper API.
+LOCAL_WHISPER_THRESHOLD = int(os.getenv("LOCAL_WHISPER_THRESHOLD", "120"))  # секунды
+LOCAL_WHISPER_MODEL = os.getenv("LOCAL_WHISPER_MODEL", "large-v3")
+LOCAL_WHISPER_DEVICE = os.getenv("LOCAL_WHISPER_DEVICE", "cuda")
+LOCAL_WHISPER_COMPUTE = os.getenv("LOCAL_WHISPER_COMPUTE", "float16")
+
+# Лимиты входящих голосовых: всё, что больше, отклоняется ещё до скачивания —
+# не тратим трафик и квоту Whisper на заведомо неподъёмные файлы
+MAX_VOICE_BYTES = int(os.getenv("MAX_VOICE_BYTES", str(10 * 1024 * 1024)))  # 10 МБ
+MAX_VOICE_DURATION = int(os.getenv("MAX_VOICE_DURATION", "900"))  # секунды (15 минут)